@@ -5,20 +5,48 @@ Automatiza todas las tareas de mantenimiento: servicios, feeds, limpieza, optimi
 """
 
 import subprocess
+import concurrent.futures
+import functools
 import json
 import os
 import shutil
-import glob
 import smtplib
+import tempfile
 import argparse
 import datetime
+import time
+from collections import namedtuple
+from io import BytesIO
 from pathlib import Path
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from cryptography import x509
 from gvm.connections import UnixSocketConnection
 from gvm.protocols.gmp import Gmp
 import xml.etree.ElementTree as ET
 
+try:
+    import orjson
+except ImportError:
+    # Opcional: si no está instalado se usa json de la librería estándar
+    orjson = None
+
+# Valores por defecto de la sección "maintenance" de config.json
+MAINTENANCE_DEFAULTS = {
+    'report_retention_days': 90,
+    'report_delete_workers': 4,
+    'max_reports_deleted_per_run': 0,
+    'log_retention_days': 30,
+    'min_disk_space_gb': 10,
+    'restart_failed_services': False,
+    'vacuum_full_dead_ratio': 0.2,
+    'parallel_feed_sync': False,
+    'email_on_errors': True,
+}
+
+MaintenanceConfig = namedtuple('MaintenanceConfig', MAINTENANCE_DEFAULTS)
+
+
 class MaintenanceReport:
     """Clase para generar reportes de mantenimiento"""
     def __init__(self):
@@ -34,33 +62,58 @@ class MaintenanceReport:
             'warnings': [],
             'summary': {}
         }
+        self._summary_cache = None
     
     def add_service_status(self, service, status, message=""):
         self.report['services'][service] = {'status': status, 'message': message}
+        self._summary_cache = None
     
     def add_feed_update(self, feed_type, status, message=""):
         self.report['feeds'][feed_type] = {'status': status, 'message': message}
+        self._summary_cache = None
     
     def add_cleanup(self, item_type, count, size_freed=0):
         if item_type not in self.report['cleanup']:
             self.report['cleanup'][item_type] = {'count': 0, 'size_freed_mb': 0}
         self.report['cleanup'][item_type]['count'] += count
         self.report['cleanup'][item_type]['size_freed_mb'] += size_freed
+        self._summary_cache = None
     
     def add_error(self, error):
         self.report['errors'].append(error)
+        self._summary_cache = None
     
     def add_warning(self, warning):
         self.report['warnings'].append(warning)
+        self._summary_cache = None
     
     def save(self, filepath):
         """Guarda el reporte en formato JSON"""
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w') as f:
-            json.dump(self.report, f, indent=2)
+        if orjson is not None:
+            data = orjson.dumps(self.report, option=orjson.OPT_INDENT_2)
+            with open(filepath, 'wb') as f:
+                f.write(data)
+        else:
+            with open(filepath, 'w') as f:
+                json.dump(self.report, f, indent=2)
+    
+    def save_all(self, log_dir):
+        """Guarda el reporte en JSON y en texto con el mismo nombre base y devuelve ambas rutas"""
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        base = os.path.join(log_dir, f'maintenance_report_{timestamp}')
+        self.save(f'{base}.json')
+        with open(f'{base}.txt', 'w') as f:
+            f.write(self.get_summary_text())
+        return f'{base}.json', f'{base}.txt'
     
     def get_summary_text(self):
-        """Genera un resumen en texto del reporte"""
+        """Genera un resumen en texto del reporte (cacheado hasta la siguiente modificación)"""
+        if self._summary_cache is None:
+            self._summary_cache = self._build_summary_text()
+        return self._summary_cache
+    
+    def _build_summary_text(self):
         lines = []
         lines.append("=" * 60)
         lines.append("REPORTE DE MANTENIMIENTO OPENVAS")
@@ -110,11 +163,17 @@ class MaintenanceReport:
         return "\n".join(lines)
 
 
+@functools.lru_cache(maxsize=4)
+def _cargar_configuracion(config_path, mtime_ns):
+    """Parsea el JSON de configuración; mtime_ns invalida la caché si el archivo cambia"""
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
 def leer_configuracion(config_path='/home/redteam/gvm/Config/config.json'):
     """Lee la configuración desde el archivo JSON"""
     try:
-        with open(config_path, 'r') as f:
-            return json.load(f)
+        return _cargar_configuracion(config_path, os.stat(config_path).st_mtime_ns)
     except FileNotFoundError:
         print(f"Error: No se encontró el archivo de configuración: {config_path}")
         return None
@@ -123,8 +182,29 @@ def leer_configuracion(config_path='/home/redteam/gvm/Config/config.json'):
         return None
 
 
-def verificar_servicio(service_name, report):
-    """Verifica el estado de un servicio systemd"""
+def estado_servicio(service_name, salida):
+    """Interpreta una línea de salida de `systemctl is-active` para un servicio"""
+    if salida == 'active':
+        return service_name, True, {'status': 'ok', 'message': 'Servicio activo'}
+    return service_name, False, {
+        'status': 'failed',
+        'message': f'Servicio no activo: {salida}',
+        'error': f"Servicio {service_name} no está activo"
+    }
+
+
+def leer_config_mantenimiento(config):
+    """Extrae una sola vez la sección "maintenance" de la configuración, con sus valores por defecto"""
+    mc = config.get('maintenance', {})
+    return MaintenanceConfig(**{k: mc.get(k, default) for k, default in MAINTENANCE_DEFAULTS.items()})
+
+
+def verificar_servicio(service_name):
+    """
+    Verifica el estado de un servicio systemd.
+    Devuelve (servicio, activo, estado) sin tocar el reporte, para poder
+    ejecutarse en paralelo desde un pool de hilos.
+    """
     try:
         result = subprocess.run(
             ['systemctl', 'is-active', service_name],
@@ -132,23 +212,63 @@ def verificar_servicio(service_name, report):
             text=True,
             timeout=5
         )
-        is_active = result.stdout.strip() == 'active'
-        
-        if is_active:
-            report.add_service_status(service_name, 'ok', 'Servicio activo')
-            return True
-        else:
-            report.add_service_status(service_name, 'failed', f'Servicio no activo: {result.stdout.strip()}')
-            report.add_error(f"Servicio {service_name} no está activo")
-            return False
+        return estado_servicio(service_name, result.stdout.strip())
     except subprocess.TimeoutExpired:
-        report.add_service_status(service_name, 'timeout', 'Timeout al verificar servicio')
-        report.add_warning(f"Timeout al verificar servicio {service_name}")
-        return False
+        return service_name, False, {
+            'status': 'timeout',
+            'message': 'Timeout al verificar servicio',
+            'warning': f"Timeout al verificar servicio {service_name}"
+        }
     except Exception as e:
-        report.add_service_status(service_name, 'error', str(e))
-        report.add_error(f"Error al verificar servicio {service_name}: {e}")
-        return False
+        return service_name, False, {
+            'status': 'error',
+            'message': str(e),
+            'error': f"Error al verificar servicio {service_name}: {e}"
+        }
+
+
+def registrar_estado_servicio(report, service_name, status):
+    """Vuelca en el reporte el estado devuelto por verificar_servicio"""
+    report.add_service_status(service_name, status['status'], status['message'])
+    if 'error' in status:
+        report.add_error(status['error'])
+    if 'warning' in status:
+        report.add_warning(status['warning'])
+
+
+def verificar_servicios_bulk(services, report):
+    """
+    Verifica todos los servicios con una única llamada a `systemctl is-active`,
+    que imprime una línea de estado por unidad en el mismo orden.
+    Devuelve la lista de servicios fallidos, o None si la salida no se puede
+    interpretar (el llamante debe recurrir a verificar_servicio).
+    """
+    try:
+        result = subprocess.run(
+            ['systemctl', 'is-active', *services],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+    except subprocess.TimeoutExpired:
+        report.add_warning("Timeout al verificar servicios con systemctl, verificando uno a uno")
+        return None
+    except Exception as e:
+        report.add_warning(f"Error al verificar servicios con systemctl, verificando uno a uno: {e}")
+        return None
+    
+    salidas = result.stdout.splitlines()
+    if len(salidas) != len(services):
+        report.add_warning("Salida inesperada de systemctl is-active, verificando servicios uno a uno")
+        return None
+    
+    servicios_fallidos = []
+    for service_name, salida in zip(services, salidas):
+        _, activo, estado = estado_servicio(service_name, salida.strip())
+        registrar_estado_servicio(report, service_name, estado)
+        if not activo:
+            servicios_fallidos.append(service_name)
+    return servicios_fallidos
 
 
 def reiniciar_servicio(service_name, report, dry_run=False):
@@ -160,7 +280,8 @@ def reiniciar_servicio(service_name, report, dry_run=False):
     try:
         result = subprocess.run(
             ['sudo', 'systemctl', 'restart', service_name],
-            capture_output=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             text=True,
             timeout=30
         )
@@ -175,7 +296,7 @@ def reiniciar_servicio(service_name, report, dry_run=False):
         return False
 
 
-def verificar_servicios(config, report, restart_failed=False, dry_run=False):
+def verificar_servicios(mcfg, report, dry_run=False):
     """Verifica todos los servicios críticos de OpenVAS"""
     print("\n[1/7] Verificando servicios del sistema...")
     
@@ -184,21 +305,42 @@ def verificar_servicios(config, report, restart_failed=False, dry_run=False):
     
     todos_servicios = servicios_criticos + servicios_soporte
     
-    servicios_fallidos = []
-    for servicio in todos_servicios:
-        if not verificar_servicio(servicio, report):
-            servicios_fallidos.append(servicio)
+    servicios_fallidos = verificar_servicios_bulk(todos_servicios, report)
     
-    # Reiniciar servicios fallidos si está configurado
-    if restart_failed and servicios_fallidos and not dry_run:
-        print(f"Reiniciando servicios fallidos: {', '.join(servicios_fallidos)}")
-        for servicio in servicios_fallidos:
-            reiniciar_servicio(servicio, report, dry_run)
+    # systemctl es I/O (fork/exec + dbus): los hilos solapan las esperas
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(todos_servicios)) as executor:
+        if servicios_fallidos is None:
+            servicios_fallidos = []
+            for servicio, activo, estado in executor.map(verificar_servicio, todos_servicios):
+                registrar_estado_servicio(report, servicio, estado)
+                if not activo:
+                    servicios_fallidos.append(servicio)
+        
+        # Reiniciar servicios fallidos si está configurado
+        if mcfg.restart_failed_services and servicios_fallidos and not dry_run:
+            print(f"Reiniciando servicios fallidos: {', '.join(servicios_fallidos)}")
+            list(executor.map(lambda s: reiniciar_servicio(s, report, dry_run), servicios_fallidos))
     
     print(f"Servicios verificados: {len(todos_servicios)}, Fallidos: {len(servicios_fallidos)}")
 
 
-def actualizar_feeds(config, report, dry_run=False):
+def cola_stderr(stderr, limite=200):
+    """Decodifica solo los últimos bytes de stderr, que es lo único que se reporta"""
+    return (stderr or b'')[-limite:].decode('utf-8', 'replace')
+
+
+def registrar_feed(report, feed_type, returncode, stderr):
+    """Vuelca en el reporte el resultado de la sincronización de un feed"""
+    if returncode == 0:
+        report.add_feed_update(feed_type, 'ok', 'Actualización completada')
+        print(f"  ✓ {feed_type} actualizado")
+    else:
+        report.add_feed_update(feed_type, 'error', stderr[:200])
+        report.add_warning(f"Error al actualizar feed {feed_type}")
+        print(f"  ✗ {feed_type} error: {stderr[:100]}")
+
+
+def actualizar_feeds(mcfg, report, dry_run=False):
     """Actualiza los feeds de vulnerabilidades de OpenVAS"""
     print("\n[2/7] Actualizando feeds de vulnerabilidades...")
     
@@ -209,131 +351,243 @@ def actualizar_feeds(config, report, dry_run=False):
         ('CERT', 'greenbone-feed-sync --type CERT')
     ]
     
-    for feed_type, command in feeds:
-        if dry_run:
+    if dry_run:
+        for feed_type, command in feeds:
             print(f"[DRY-RUN] Ejecutaría: sudo -u gvm {command}")
             report.add_feed_update(feed_type, 'simulated', 'Simulado en dry-run')
-            continue
-        
+        return
+    
+    # El NVT se sincroniza siempre primero y en serie (comparte lockfiles);
+    # el resto de feeds puede descargarse a la vez si está configurado
+    feeds_serie = feeds[:1] if mcfg.parallel_feed_sync else feeds
+    feeds_paralelo = feeds[1:] if mcfg.parallel_feed_sync else []
+    
+    for feed_type, command in feeds_serie:
         try:
             cmd_parts = command.split()
             result = subprocess.run(
                 ['sudo', '-u', 'gvm'] + cmd_parts,
-                capture_output=True,
-                text=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 timeout=3600  # 1 hora máximo
             )
-            
-            if result.returncode == 0:
-                report.add_feed_update(feed_type, 'ok', 'Actualización completada')
-                print(f"  ✓ {feed_type} actualizado")
-            else:
-                report.add_feed_update(feed_type, 'error', result.stderr[:200])
-                report.add_warning(f"Error al actualizar feed {feed_type}")
-                print(f"  ✗ {feed_type} error: {result.stderr[:100]}")
+            registrar_feed(report, feed_type, result.returncode, cola_stderr(result.stderr))
+        except subprocess.TimeoutExpired:
+            report.add_feed_update(feed_type, 'timeout', 'Timeout en actualización')
+            report.add_warning(f"Timeout al actualizar feed {feed_type}")
+        except Exception as e:
+            report.add_feed_update(feed_type, 'error', str(e))
+            report.add_error(f"Excepción al actualizar {feed_type}: {e}")
+    
+    # stderr de cada feed va a su propio archivo temporal: con pipes, mientras se
+    # espera a un proceso los demás podrían bloquearse al llenar el suyo
+    handles = []
+    for feed_type, command in feeds_paralelo:
+        err_file = tempfile.TemporaryFile()
+        try:
+            p = subprocess.Popen(
+                ['sudo', '-u', 'gvm'] + command.split(),
+                stdout=subprocess.DEVNULL,
+                stderr=err_file
+            )
+            handles.append((p, feed_type, err_file))
+        except Exception as e:
+            err_file.close()
+            report.add_feed_update(feed_type, 'error', str(e))
+            report.add_error(f"Excepción al actualizar {feed_type}: {e}")
+    
+    # Todos los feeds comparten el mismo límite de 1 hora
+    deadline = time.monotonic() + 3600
+    for p, feed_type, err_file in handles:
+        try:
+            p.wait(timeout=max(0, deadline - time.monotonic()))
+            err_file.seek(max(0, os.fstat(err_file.fileno()).st_size - 200))
+            registrar_feed(report, feed_type, p.returncode, cola_stderr(err_file.read()))
         except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
             report.add_feed_update(feed_type, 'timeout', 'Timeout en actualización')
             report.add_warning(f"Timeout al actualizar feed {feed_type}")
         except Exception as e:
             report.add_feed_update(feed_type, 'error', str(e))
             report.add_error(f"Excepción al actualizar {feed_type}: {e}")
+        finally:
+            err_file.close()
+
+
+def eliminar_reportes_lote(report_ids, user, password, path='/run/gvmd/gvmd.sock'):
+    """
+    Elimina un lote de reportes con su propia conexión GMP, para poder
+    repartir el borrado entre varios hilos.
+    Devuelve (eliminados, errores).
+    """
+    deleted = 0
+    errores = []
+    try:
+        connection = UnixSocketConnection(path=path)
+        with Gmp(connection=connection) as gmp:
+            gmp.authenticate(user, password)
+            for report_id in report_ids:
+                try:
+                    gmp.delete_report(report_id)
+                    deleted += 1
+                except Exception as e:
+                    errores.append(f"Error al eliminar reporte {report_id}: {e}")
+    except Exception as e:
+        # Fallo de conexión o autenticación: se informa sin perder los ya eliminados
+        errores.append(
+            f"Error en lote de borrado de reportes ({len(report_ids) - deleted} sin eliminar): {e}"
+        )
+    return deleted, errores
 
 
-def limpiar_reportes_antiguos(config, report, dry_run=False):
+def limpiar_reportes_antiguos(config, mcfg, report, dry_run=False):
     """Limpia reportes antiguos de OpenVAS"""
     print("\n[3/7] Limpiando reportes antiguos...")
     
-    retention_days = config.get('maintenance', {}).get('report_retention_days', 90)
-    cutoff_date = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    workers = max(1, mcfg.report_delete_workers)
+    max_deletes = mcfg.max_reports_deleted_per_run
+    cutoff_date = datetime.datetime.now() - datetime.timedelta(days=mcfg.report_retention_days)
     
     try:
         path = '/run/gvmd/gvmd.sock'
         connection = UnixSocketConnection(path=path)
+        user = config.get('user', 'admin')
+        password = config.get('password', 'admin')
         
         with Gmp(connection=connection) as gmp:
-            user = config.get('user', 'admin')
-            password = config.get('password', 'admin')
             gmp.authenticate(user, password)
             
-            # Obtener todos los reportes
-            response = gmp.get_reports(filter_string='rows=-1')
-            root = ET.fromstring(response)
-            reports = root.findall(".//report")
-            
+            # gvmd filtra por fecha de creación y devuelve solo los ids,
+            # sin el contenido de cada reporte
+            cutoff_str = cutoff_date.strftime('%Y-%m-%d')
+            response = gmp.get_reports(
+                filter_string=f'created<{cutoff_str} rows=-1',
+                details=False,
+                ignore_pagination=True
+            )
+        if isinstance(response, str):
+            response = response.encode('utf-8')
+        
+        report_ids = []
+        # Se procesa en streaming y se libera cada subárbol. Solo cuentan los
+        # <report> de primer nivel: cada uno contiene otro anidado con el mismo id
+        depth = 0
+        for event, elem in ET.iterparse(BytesIO(response), events=('start', 'end')):
+            if elem.tag != 'report':
+                continue
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                report_ids.append(elem.get('id'))
+                elem.clear()
+        
+        # Límite opcional de borrados por ejecución (0 = sin límite)
+        if max_deletes and len(report_ids) > max_deletes:
+            report.add_warning(
+                f"Se eliminarán {max_deletes} de {len(report_ids)} reportes antiguos "
+                f"(max_reports_deleted_per_run)"
+            )
+            report_ids = report_ids[:max_deletes]
+        
+        if dry_run:
+            deleted_count = len(report_ids)
+        else:
+            # Reparto de los ids entre varias conexiones GMP en paralelo
+            lotes = [report_ids[i::workers] for i in range(workers) if report_ids[i::workers]]
             deleted_count = 0
-            for report_elem in reports:
-                report_id = report_elem.get('id')
-                timestamp_elem = report_elem.find('.//timestamp')
-                
-                if timestamp_elem is not None:
-                    timestamp_str = timestamp_elem.text
-                    try:
-                        # Formato: 2024-01-15T10:30:00Z
-                        report_date = datetime.datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                        if report_date < cutoff_date:
-                            if not dry_run:
-                                gmp.delete_report(report_id)
-                            deleted_count += 1
-                    except (ValueError, AttributeError):
-                        # Si no se puede parsear la fecha, saltar
-                        continue
-            
-            report.add_cleanup('reports', deleted_count)
-            print(f"  Reportes eliminados: {deleted_count}")
+            if lotes:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(lotes)) as executor:
+                    resultados = executor.map(
+                        lambda lote: eliminar_reportes_lote(lote, user, password, path),
+                        lotes
+                    )
+                    for deleted, errores in resultados:
+                        deleted_count += deleted
+                        for error in errores:
+                            report.add_error(error)
+        
+        report.add_cleanup('reports', deleted_count)
+        print(f"  Reportes eliminados: {deleted_count}")
             
     except Exception as e:
         report.add_error(f"Error al limpiar reportes: {e}")
         print(f"  Error: {e}")
 
 
-def limpiar_archivos_temporales(config, report, dry_run=False):
+def seleccionar_archivos(directorio, extension, report, cutoff_ts=None):
+    """
+    Recorre un directorio con scandir (un único stat por archivo) y devuelve
+    (ruta, tamaño) de los archivos con la extensión dada y, si se indica
+    cutoff_ts, modificados antes de ese instante.
+    """
+    victims = []
+    if not os.path.exists(directorio):
+        return victims
+    try:
+        with os.scandir(directorio) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.endswith(extension):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    if cutoff_ts is None or st.st_mtime < cutoff_ts:
+                        victims.append((entry.path, st.st_size))
+                except Exception as e:
+                    report.add_warning(f"Error al leer {entry.path}: {e}")
+    except OSError as e:
+        # Un directorio ilegible no debe abortar el resto del mantenimiento
+        report.add_warning(f"Error al leer {directorio}: {e}")
+    return victims
+
+
+def eliminar_archivos(victims, report, dry_run=False, etiqueta=''):
+    """
+    Elimina en una sola pasada una lista de archivos (ruta, tamaño) ya seleccionados.
+    Devuelve (eliminados, bytes liberados).
+    """
+    count = 0
+    size = 0
+    for path, file_size in victims:
+        try:
+            if not dry_run:
+                os.unlink(path)
+            count += 1
+            size += file_size
+        except Exception as e:
+            report.add_warning(f"Error al eliminar {etiqueta}{path}: {e}")
+    return count, size
+
+
+def limpiar_archivos_temporales(mcfg, report, dry_run=False):
     """Limpia archivos CSV y logs temporales"""
     print("\n[4/7] Limpiando archivos temporales...")
     
     # Limpiar CSVs en Reports/exports
     csv_dir = '/home/redteam/gvm/Reports/exports/'
-    csv_count = 0
-    csv_size = 0
-    
-    if os.path.exists(csv_dir):
-        csv_files = glob.glob(os.path.join(csv_dir, '*.csv'))
-        for csv_file in csv_files:
-            try:
-                size = os.path.getsize(csv_file)
-                if not dry_run:
-                    os.remove(csv_file)
-                csv_count += 1
-                csv_size += size
-            except Exception as e:
-                report.add_warning(f"Error al eliminar {csv_file}: {e}")
-    
+    csv_victims = seleccionar_archivos(csv_dir, '.csv', report)
+    csv_count, csv_size = eliminar_archivos(csv_victims, report, dry_run)
     report.add_cleanup('csv_files', csv_count, csv_size / (1024 * 1024))
     
     # Limpiar logs antiguos
-    log_retention_days = config.get('maintenance', {}).get('log_retention_days', 30)
-    log_cutoff = datetime.datetime.now() - datetime.timedelta(days=log_retention_days)
+    log_cutoff = datetime.datetime.now() - datetime.timedelta(days=mcfg.log_retention_days)
     
     log_dirs = [
         '/var/log/gvm/',
         '/home/redteam/gvm/'
     ]
     
-    log_count = 0
-    log_size = 0
-    
+    # Una sola pasada por directorio: se seleccionan los logs anteriores al corte
+    # y después se eliminan todos juntos
+    cutoff_ts = log_cutoff.timestamp()
+    log_victims = []
     for log_dir in log_dirs:
-        if os.path.exists(log_dir):
-            for log_file in glob.glob(os.path.join(log_dir, '*.log')):
-                try:
-                    mtime = datetime.datetime.fromtimestamp(os.path.getmtime(log_file))
-                    if mtime < log_cutoff:
-                        size = os.path.getsize(log_file)
-                        if not dry_run:
-                            os.remove(log_file)
-                        log_count += 1
-                        log_size += size
-                except Exception as e:
-                    report.add_warning(f"Error al eliminar log {log_file}: {e}")
+        log_victims += seleccionar_archivos(log_dir, '.log', report, cutoff_ts)
+    log_count, log_size = eliminar_archivos(log_victims, report, dry_run, 'log ')
     
     report.add_cleanup('log_files', log_count, log_size / (1024 * 1024))
     
@@ -344,15 +598,8 @@ def limpiar_archivos_temporales(config, report, dry_run=False):
         '/home/redteam/gvm/logbalbix.txt'
     ]
     
-    temp_count = 0
-    for temp_file in temp_files:
-        if os.path.exists(temp_file):
-            try:
-                if not dry_run:
-                    os.remove(temp_file)
-                temp_count += 1
-            except Exception as e:
-                report.add_warning(f"Error al eliminar {temp_file}: {e}")
+    temp_victims = [(temp_file, 0) for temp_file in temp_files if os.path.exists(temp_file)]
+    temp_count, _ = eliminar_archivos(temp_victims, report, dry_run)
     
     report.add_cleanup('temp_files', temp_count)
     print(f"  Archivos CSV eliminados: {csv_count}")
@@ -360,120 +607,161 @@ def limpiar_archivos_temporales(config, report, dry_run=False):
     print(f"  Archivos temporales eliminados: {temp_count}")
 
 
-def verificar_espacio_disco(config, report):
+def verificar_espacio_disco(mcfg, report):
     """Verifica el espacio disponible en disco"""
     print("\n[5/7] Verificando espacio en disco...")
     
-    min_space_gb = config.get('maintenance', {}).get('min_disk_space_gb', 10)
+    min_space_gb = mcfg.min_disk_space_gb
     
     try:
-        result = subprocess.run(
-            ['df', '-h', '/'],
-            capture_output=True,
-            text=True
-        )
+        # statvfs directo: bytes exactos sin lanzar ni parsear `df`
+        available_gb = shutil.disk_usage('/').free / (1024 ** 3)
         
-        lines = result.stdout.strip().split('\n')
-        if len(lines) > 1:
-            parts = lines[1].split()
-            if len(parts) >= 4:
-                # parts[3] es el espacio disponible
-                available = parts[3]
-                # Convertir a GB
-                if 'G' in available:
-                    available_gb = float(available.replace('G', ''))
-                elif 'M' in available:
-                    available_gb = float(available.replace('M', '')) / 1024
-                else:
-                    available_gb = 0
-                
-                report.report['disk_space'] = {
-                    'available_gb': available_gb,
-                    'min_required_gb': min_space_gb,
-                    'status': 'ok' if available_gb >= min_space_gb else 'warning'
-                }
-                
-                if available_gb < min_space_gb:
-                    report.add_warning(f"Espacio en disco bajo: {available_gb:.2f} GB disponible (mínimo: {min_space_gb} GB)")
-                else:
-                    print(f"  Espacio disponible: {available_gb:.2f} GB")
+        report.report['disk_space'] = {
+            'available_gb': available_gb,
+            'min_required_gb': min_space_gb,
+            'status': 'ok' if available_gb >= min_space_gb else 'warning'
+        }
+        
+        if available_gb < min_space_gb:
+            report.add_warning(f"Espacio en disco bajo: {available_gb:.2f} GB disponible (mínimo: {min_space_gb} GB)")
+        else:
+            print(f"  Espacio disponible: {available_gb:.2f} GB")
     except Exception as e:
         report.add_error(f"Error al verificar espacio en disco: {e}")
 
 
-def optimizar_base_datos(config, report, dry_run=False):
+MARCADOR_PASO = '@@paso'
+
+
+def errores_por_paso(stderr):
+    """
+    Reparte las líneas "ERROR:" de stderr de psql entre los pasos, usando los
+    marcadores escritos con \\warn antes de cada uno. Devuelve {paso: [errores]}.
+    """
+    errores = {}
+    paso = None
+    for linea in stderr.splitlines():
+        if linea.startswith(MARCADOR_PASO):
+            paso = linea[len(MARCADOR_PASO):].strip()
+        elif 'ERROR:' in linea:
+            errores.setdefault(paso, []).append(linea.split('ERROR:', 1)[1].strip())
+        elif 'STATEMENT:' in linea:
+            # ECHO=errors: sentencia que ha fallado, se añade al último error
+            if errores.get(paso):
+                errores[paso][-1] += f" ({linea.split('STATEMENT:', 1)[1].strip()})"
+    return errores
+
+
+def optimizar_base_datos(mcfg, report, dry_run=False):
     """Optimiza la base de datos PostgreSQL"""
     print("\n[6/7] Optimizando base de datos PostgreSQL...")
     
+    # Solo se reescriben (VACUUM FULL, con lock exclusivo) las tablas con muchas
+    # tuplas muertas; VACUUM FULL reconstruye también sus índices, así que no
+    # hace falta un REINDEX de toda la base de datos
+    try:
+        dead_ratio = float(mcfg.vacuum_full_dead_ratio)
+    except (TypeError, ValueError):
+        dead_ratio = MAINTENANCE_DEFAULTS['vacuum_full_dead_ratio']
+        report.add_warning(
+            f"vacuum_full_dead_ratio no es numérico ({mcfg.vacuum_full_dead_ratio!r}), "
+            f"se usa {dead_ratio}"
+        )
+    tablas_infladas = (
+        "FROM pg_stat_user_tables WHERE n_live_tup > 1000 "
+        f"AND n_dead_tup::float / NULLIF(n_live_tup, 0) > {dead_ratio}"
+    )
+    
     if dry_run:
-        print("[DRY-RUN] Ejecutaría VACUUM FULL, ANALYZE y REINDEX en base de datos gvmd")
+        print(f"[DRY-RUN] Ejecutaría VACUUM FULL en tablas con más del "
+              f"{dead_ratio:.0%} de tuplas muertas, VACUUM y ANALYZE en base de datos gvmd")
         report.report['database'] = {'status': 'simulated'}
         return
     
+    # Todo se ejecuta en una única sesión de psql (un sudo y un backend).
+    # Antes de cada paso se escribe un marcador en stderr (\warn) para poder
+    # atribuir a cada paso sus líneas "ERROR:"; con ECHO=errors psql incluye
+    # además la sentencia fallida (p. ej. la tabla de un VACUUM FULL generado)
+    pasos = [
+        ('vacuum_full', 'VACUUM FULL',
+         f"SELECT format('VACUUM (FULL, ANALYZE) %I.%I', schemaname, relname) {tablas_infladas} \\gexec"),
+        ('vacuum', 'VACUUM', 'VACUUM;'),
+        # ANALYZE actualiza las estadísticas del optimizador
+        ('analyze', 'ANALYZE', 'ANALYZE;'),
+    ]
+    script = ["\\set ECHO errors",
+              "SELECT pg_size_pretty(pg_database_size('gvmd')) AS size_before \\gset",
+              "\\echo size_before :size_before",
+              f"SELECT count(*) AS bloated {tablas_infladas} \\gset",
+              "\\echo bloated :bloated"]
+    for clave, _, sql in pasos:
+        script += [f"\\warn {MARCADOR_PASO} {clave}", sql, f"\\echo {clave} :ERROR"]
+    script += [f"\\warn {MARCADOR_PASO} fin"]
+    script += ["SELECT pg_size_pretty(pg_database_size('gvmd')) AS size_after \\gset",
+               "\\echo size_after :size_after"]
+    
     try:
-        # Obtener tamaño de la base de datos antes
-        result_before = subprocess.run(
-            ['sudo', '-u', 'postgres', 'psql', '-d', 'gvmd', '-c', 
-             "SELECT pg_size_pretty(pg_database_size('gvmd'));"],
-            capture_output=True,
-            text=True
-        )
-        
-        size_before = result_before.stdout.strip() if result_before.returncode == 0 else "N/A"
-        
-        # Ejecutar VACUUM FULL (bloquea la BD pero recupera más espacio)
-        result_vacuum = subprocess.run(
-            ['sudo', '-u', 'postgres', 'psql', '-d', 'gvmd', '-c', 'VACUUM FULL;'],
+        result = subprocess.run(
+            ['sudo', '-u', 'postgres', 'psql', '-X', '-q', '-A', '-t', '-d', 'gvmd'],
+            input="\n".join(script) + "\n",
             capture_output=True,
             text=True,
-            timeout=3600
+            timeout=9000  # VACUUM FULL y VACUUM 1 hora cada uno, ANALYZE 30 minutos
         )
         
-        if result_vacuum.returncode == 0:
-            print("  ✓ VACUUM FULL completado")
-        else:
-            report.add_warning(f"VACUUM FULL completado con advertencias: {result_vacuum.stderr[:200]}")
+        salida = {}
+        for linea in result.stdout.splitlines():
+            clave, _, valor = linea.partition(' ')
+            salida[clave] = valor.strip()
         
-        # Ejecutar ANALYZE para actualizar estadísticas del optimizador
-        result_analyze = subprocess.run(
-            ['sudo', '-u', 'postgres', 'psql', '-d', 'gvmd', '-c', 'ANALYZE;'],
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 minutos máximo para ANALYZE
-        )
-        
-        if result_analyze.returncode == 0:
-            print("  ✓ ANALYZE completado")
-        else:
-            report.add_warning(f"ANALYZE completado con advertencias: {result_analyze.stderr[:200]}")
+        # Sin el primer marcador, psql no llegó a ejecutar el script (sudo, conexión...)
+        if 'size_before' not in salida:
+            report.add_error(f"No se pudo ejecutar psql en la base de datos gvmd "
+                             f"(código {result.returncode}): {result.stderr[:200]}")
+            report.report['database'] = {'status': 'error'}
+            return
         
-        # Ejecutar REINDEX
-        result_reindex = subprocess.run(
-            ['sudo', '-u', 'postgres', 'psql', '-d', 'gvmd', '-c', 'REINDEX DATABASE gvmd;'],
-            capture_output=True,
-            text=True,
-            timeout=3600
-        )
+        errores = errores_por_paso(result.stderr)
         
-        if result_reindex.returncode == 0:
-            print("  ✓ REINDEX completado")
-        else:
-            report.add_warning(f"REINDEX completado con advertencias: {result_reindex.stderr[:200]}")
+        bloated = salida.get('bloated', '')
+        vacuum_full_tables = int(bloated) if bloated.isdigit() else None
+        if vacuum_full_tables is None:
+            report.add_warning("No se pudo comprobar qué tablas superan el umbral de tuplas muertas")
+        elif vacuum_full_tables == 0:
+            print("  - VACUUM FULL omitido: ninguna tabla supera el umbral de tuplas muertas")
         
-        # Obtener tamaño después
-        result_after = subprocess.run(
-            ['sudo', '-u', 'postgres', 'psql', '-d', 'gvmd', '-c', 
-             "SELECT pg_size_pretty(pg_database_size('gvmd'));"],
-            capture_output=True,
-            text=True
-        )
+        for clave, nombre, _ in pasos:
+            fallos = errores.get(clave, [])
+            if clave == 'vacuum_full':
+                # Sin tablas infladas, o sin poder comprobarlo (ya advertido), no hay
+                # nada de lo que informar salvo que \gexec haya dado errores
+                if not vacuum_full_tables and not fallos:
+                    continue
+                if vacuum_full_tables:
+                    nombre = f"VACUUM FULL ({vacuum_full_tables} tablas)"
+                if fallos and vacuum_full_tables:
+                    # Cada sentencia generada por \gexec que falla deja su propia línea ERROR
+                    report.add_warning(
+                        f"VACUUM FULL con errores en {len(fallos)} de {vacuum_full_tables} tablas: "
+                        f"{' '.join(fallos)[:200]}"
+                    )
+                    continue
+            if salida.get(clave) == 'false' and not fallos:
+                print(f"  ✓ {nombre} completado")
+            else:
+                detalle = ' '.join(fallos) if fallos else result.stderr
+                report.add_warning(f"{nombre} completado con advertencias: {detalle[:200]}")
         
-        size_after = result_after.stdout.strip() if result_after.returncode == 0 else "N/A"
+        # Si el SELECT falla, psql deja la variable sin interpolar (":size_before")
+        size_before = salida.get('size_before', '')
+        size_after = salida.get('size_after', '')
         
         report.report['database'] = {
             'status': 'ok',
-            'size_before': size_before,
-            'size_after': size_after
+            'vacuum_full_tables': vacuum_full_tables if vacuum_full_tables is not None else "N/A",
+            'size_before': size_before if size_before and not size_before.startswith(':') else "N/A",
+            'size_after': size_after if size_after and not size_after.startswith(':') else "N/A"
         }
         
     except subprocess.TimeoutExpired:
@@ -482,7 +770,7 @@ def optimizar_base_datos(config, report, dry_run=False):
         report.add_error(f"Error al optimizar base de datos: {e}")
 
 
-def verificar_certificados(config, report):
+def verificar_certificados(mcfg, report):
     """Verifica la validez de los certificados SSL/TLS"""
     print("\n[7/7] Verificando certificados SSL/TLS...")
     
@@ -491,21 +779,24 @@ def verificar_certificados(config, report):
         '/var/lib/gvm/CA/servercert.pem'
     ]
     
+    now = datetime.datetime.now(datetime.timezone.utc)
     cert_status = {}
     for cert_path in cert_paths:
         if os.path.exists(cert_path):
             try:
-                result = subprocess.run(
-                    ['openssl', 'x509', '-in', cert_path, '-noout', '-enddate'],
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode == 0:
-                    # Parsear fecha de expiración
-                    expiry_line = result.stdout.strip()
-                    cert_status[cert_path] = {'status': 'ok', 'expiry': expiry_line}
-                else:
-                    cert_status[cert_path] = {'status': 'error', 'message': result.stderr}
+                with open(cert_path, 'rb') as f:
+                    cert = x509.load_pem_x509_certificate(f.read())
+                expiry = cert.not_valid_after_utc
+                days_left = (expiry - now).days
+                cert_status[cert_path] = {
+                    'status': 'ok' if days_left >= 0 else 'expired',
+                    'expiry': expiry.isoformat(),
+                    'days_left': days_left
+                }
+                if days_left < 0:
+                    report.add_warning(f"Certificado caducado: {cert_path} ({expiry:%Y-%m-%d})")
+                elif days_left < 30:
+                    report.add_warning(f"Certificado {cert_path} caduca en {days_left} días ({expiry:%Y-%m-%d})")
             except Exception as e:
                 cert_status[cert_path] = {'status': 'error', 'message': str(e)}
         else:
@@ -515,12 +806,10 @@ def verificar_certificados(config, report):
     print(f"  Certificados verificados: {len(cert_paths)}")
 
 
-def enviar_email_reporte(config, report):
-    """Envía el reporte por email"""
-    email_on_errors = config.get('maintenance', {}).get('email_on_errors', True)
-    
+def enviar_email_reporte(config, mcfg, report, summary_text=None):
+    """Envía el reporte por email (summary_text evita regenerar el resumen si ya se tiene)"""
     # Solo enviar si hay errores o está configurado para enviar siempre
-    if not email_on_errors and not report.report['errors']:
+    if not mcfg.email_on_errors and not report.report['errors']:
         return
     
     try:
@@ -535,7 +824,8 @@ def enviar_email_reporte(config, report):
         
         subject = f'[{pais}-{site}] Reporte de Mantenimiento OpenVAS'
         
-        summary_text = report.get_summary_text()
+        if summary_text is None:
+            summary_text = report.get_summary_text()
         message_html = f'''<html>
         <head></head>
         <body>
@@ -550,13 +840,13 @@ def enviar_email_reporte(config, report):
         msg['Subject'] = subject
         msg.attach(MIMEText(message_html, 'html'))
         
-        smtp = smtplib.SMTP(smtp_server, smtp_port)
-        smtp.ehlo()
-        smtp.starttls()
-        smtp.ehlo()
-        smtp.login(smtp_user, smtp_pass)
-        smtp.sendmail(from_address, to_address, msg.as_string())
-        smtp.quit()
+        # El bloque with garantiza el QUIT aunque falle el login o el envío
+        with smtplib.SMTP(smtp_server, smtp_port) as smtp:
+            smtp.ehlo()
+            smtp.starttls()
+            smtp.ehlo()
+            smtp.login(smtp_user, smtp_pass)
+            smtp.send_message(msg)
         
         print("\nReporte enviado por email exitosamente")
     except Exception as e:
@@ -605,14 +895,14 @@ def main():
     report = MaintenanceReport()
     
     # Ejecutar tareas de mantenimiento
-    restart_failed = config.get('maintenance', {}).get('restart_failed_services', False)
-    verificar_servicios(config, report, restart_failed, args.dry_run)
-    actualizar_feeds(config, report, args.dry_run)
-    limpiar_reportes_antiguos(config, report, args.dry_run)
-    limpiar_archivos_temporales(config, report, args.dry_run)
-    verificar_espacio_disco(config, report)
-    optimizar_base_datos(config, report, args.dry_run)
-    verificar_certificados(config, report)
+    mcfg = leer_config_mantenimiento(config)
+    verificar_servicios(mcfg, report, args.dry_run)
+    actualizar_feeds(mcfg, report, args.dry_run)
+    limpiar_reportes_antiguos(config, mcfg, report, args.dry_run)
+    limpiar_archivos_temporales(mcfg, report, args.dry_run)
+    verificar_espacio_disco(mcfg, report)
+    optimizar_base_datos(mcfg, report, args.dry_run)
+    verificar_certificados(mcfg, report)
     
     # Generar resumen
     print("\n" + "=" * 60)
@@ -621,22 +911,13 @@ def main():
     summary = report.get_summary_text()
     print(summary)
     
-    # Guardar reporte
-    log_dir = '/home/redteam/gvm/logs/maintenance/'
-    os.makedirs(log_dir, exist_ok=True)
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    report_file = os.path.join(log_dir, f'maintenance_report_{timestamp}.json')
-    report.save(report_file)
+    # Guardar reporte en JSON y texto (el resumen ya está cacheado)
+    report_file, _ = report.save_all('/home/redteam/gvm/logs/maintenance/')
     print(f"\nReporte guardado en: {report_file}")
     
-    # Guardar también en texto
-    text_file = os.path.join(log_dir, f'maintenance_report_{timestamp}.txt')
-    with open(text_file, 'w') as f:
-        f.write(summary)
-    
     # Enviar email si está configurado
     if not args.no_email:
-        enviar_email_reporte(config, report)
+        enviar_email_reporte(config, mcfg, report, summary)
     
     # Retornar código de salida basado en errores
     return 1 if report.report['errors'] else 0
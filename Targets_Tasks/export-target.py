@@ -1,16 +1,68 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import os
+import tempfile
 import csv
+import re
 import xml.etree.ElementTree as ET
+from io import BytesIO
 
 from gvm.connections import UnixSocketConnection
 from gvm.protocols.gmp import Gmp
 
-def export_targets_csv(config_path: str, csv_path: str, page_size: int = 1000) -> None:
+_WS = re.compile(r'\s+')
+
+
+def normalizar(texto) -> str:
+    """Colapsa cualquier secuencia de espacios, tabuladores o saltos de línea en un espacio"""
+    return _WS.sub(' ', texto).strip() if texto else ''
+
+
+def iter_elementos(response_xml, *tags: str):
+    """
+    Recorre en streaming los elementos <tag> de una respuesta GMP, liberando
+    cada subárbol tras procesarlo para mantener la memoria constante.
+    """
+    if isinstance(response_xml, str):
+        response_xml = response_xml.encode('utf-8')
+    for _, elem in ET.iterparse(BytesIO(response_xml), events=('end',)):
+        if elem.tag in tags:
+            yield elem
+            elem.clear()
+
+
+def filas_targets(response_xml, pagina: dict):
+    """
+    Genera las filas (Titulo, Rango, Desc) de una respuesta get_targets, una por
+    cada rango IP. Anota en pagina['count'] los targets leídos y en
+    pagina['total'] el total de targets que cumplen el filtro.
     """
-    Exporta todos los targets de OpenVAS en formato CSV, evitando el límite de 1 000 filas
-    mediante paginación. El CSV tendrá columnas Titulo;Rango;Desc.
+    for target in iter_elementos(response_xml, 'target', 'filtered'):
+        if target.tag == 'filtered':
+            # <target_count><filtered>: total de targets que cumplen el filtro
+            pagina['total'] = int(target.text or 0)
+            continue
+        pagina['count'] += 1
+        titulo = normalizar(target.findtext("name"))
+        rangos_str = (target.findtext("hosts") or "").strip()
+        desc = normalizar(target.findtext("comment"))
+
+        # Dividir rangos por comas y crear una fila por cada rango
+        rangos = [r.strip() for r in rangos_str.split(',') if r.strip()]
+        if rangos:
+            for rango in rangos:
+                yield (titulo, rango, desc)
+        else:
+            # Si no hay rangos, escribir una fila vacía
+            yield (titulo, "", desc)
+
+
+def export_targets_csv(config_path: str, csv_path: str) -> None:
+    """
+    Exporta todos los targets de OpenVAS en formato CSV. Pide todos los targets
+    en una sola llamada (rows=-1) y solo vuelve a pedir si gvmd recorta la
+    respuesta por el límite Max Rows Per Page. El CSV tendrá columnas Titulo;Rango;Desc.
     """
     # Cargar credenciales
     with open(config_path, 'r', encoding='utf-8') as f:
@@ -22,44 +74,36 @@ def export_targets_csv(config_path: str, csv_path: str, page_size: int = 1000) -
     socket_path = '/run/gvmd/gvmd.sock'
     connection = UnixSocketConnection(path=socket_path)
 
-    all_targets = []
-    with Gmp(connection=connection) as gmp:
-        gmp.authenticate(user, password)
-        start = 1
-        while True:
-            # Pedimos un bloque de targets con el filtro first/rows
-            filter_str = f"first={start} rows={page_size}"
-            response_xml = gmp.get_targets(filter_string=filter_str)
-            root = ET.fromstring(response_xml)
-            targets = root.findall('.//target')
-
-            # Añadir a la lista global
-            all_targets.extend(targets)
-            # Si recibimos menos de page_size, no hay más páginas
-            if len(targets) < page_size:
-                break
-            # Avanzar al siguiente bloque
-            start += page_size
-
-    # Escribir el CSV
-    with open(csv_path, 'w', newline='', encoding='utf-8') as f_out:
-        writer = csv.writer(f_out, delimiter=';')
-        writer.writerow(["Titulo", "Rango", "Desc"])
-        for target in all_targets:
-            titulo = (target.findtext("name") or "").strip()
-            rangos_str = (target.findtext("hosts") or "").strip()
-            desc = (target.findtext("comment") or "").strip()
-            titulo = " ".join(titulo.split())
-            desc = " ".join(desc.split())
-            
-            # Dividir rangos por comas y crear una fila por cada rango
-            if rangos_str:
-                rangos = [r.strip() for r in rangos_str.split(',') if r.strip()]
-                for rango in rangos:
-                    writer.writerow([titulo, rango, desc])
-            else:
-                # Si no hay rangos, escribir una fila vacía
-                writer.writerow([titulo, "", desc])
+    # Escribir el CSV a medida que llegan los targets en un temporal del mismo
+    # directorio; solo sustituye a csv_path si la exportación termina bien
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.export-', suffix='.csv', dir=os.path.dirname(os.path.abspath(csv_path))
+    )
+    try:
+        with open(fd, 'w', newline='', encoding='utf-8') as f_out, \
+                Gmp(connection=connection) as gmp:
+            writer = csv.writer(f_out, delimiter=';')
+            writer.writerow(["Titulo", "Rango", "Desc"])
+            gmp.authenticate(user, password)
+            start = 1
+            while True:
+                response_xml = gmp.get_targets(filter_string=f"first={start} rows=-1")
+
+                pagina = {'count': 0, 'total': 0}
+                writer.writerows(filas_targets(response_xml, pagina))
+
+                # Si gvmd ha recortado la respuesta, pedir los siguientes
+                start += pagina['count']
+                if pagina['count'] == 0 or start > pagina['total']:
+                    break
+        # mkstemp crea el archivo con permisos 0600: aplicar los habituales según umask
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, csv_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -75,12 +119,6 @@ if __name__ == "__main__":
         default="openvas.csv",
         help="Ruta del CSV de salida (por defecto: openvas.csv)"
     )
-    parser.add_argument(
-        "--page-size",
-        type=int,
-        default=1000,
-        help="Número de elementos a solicitar en cada página (no debe superar el límite Max Rows Per Page)"
-    )
     args = parser.parse_args()
-    export_targets_csv(args.config, args.output, args.page_size)
+    export_targets_csv(args.config, args.output)
 